@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import calendar
+import concurrent.futures
+import contextlib
+import html.parser
+import json
 import os
+import posixpath
 import re
 import shutil
 import subprocess
 import sys
-import urllib.request
+import threading
+import time
+import urllib3
 import xtarfile
 
 import calm.version
@@ -14,33 +22,108 @@ import calm.version
 try:
     from tqdm import tqdm
 except ImportError:
-    def tqdm(iterable):
+    def tqdm(iterable, **kwargs):
         return iterable
 
 
 CACHE_DIR = '/tmp/ctm2git/cache'
-REMOVE_EXTS = [
+REMOVE_EXTS = (
     '.tar.gz', '.tgz',
     '.tar.bz2', '.tbz',
     '.tar.lzma',
     '.tar.xz', '.txz',
     '.tar.zst',
     '.sig',
-]
+)
 DEFAULT_AUTHOR = 'unknown <unknown@unknown.invalid>'
+FETCH_WORKERS = 16
 
+SETUP_TAIL_RE = re.compile(r'^(.*)/setup\.ini$')
+SRC_DIR_RE = re.compile(r'[^/]*\.src/')
+CIRCA_RE = re.compile(r'circa/(?:64bit/|)([\d/]*)/')
+AUTHOR_NAME_RE = re.compile(r'^(.*) <')
+AUTHOR_EMAIL_RE = re.compile(r'<(.*)>')
+INI_RE = re.compile(r'^(?:@ (?P<pkg>\S+)|version:[ \t]*(?P<ver>\S+)|source:[ \t]*(?P<src>\S+))', re.MULTILINE)
+
+# all fetches are from the same host, so keep connections to it alive for
+# reuse (this is thread-safe, and shared by all the fetch workers)
+_POOL = urllib3.PoolManager(maxsize=FETCH_WORKERS, block=False)
+
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+
+@contextlib.contextmanager
+def atomic_write(fn, mode):
+    # write into a temporary file unique to this process and thread, and
+    # rename it into place when complete, so concurrent writers (threads or
+    # separate runs) never see, or leave behind, a partially written file
+    tmp_fn = f'{fn}.tmp.{os.getpid()}.{threading.get_ident()}'
+    try:
+        with open(tmp_fn, mode) as f:
+            yield f
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        if os.path.exists(tmp_fn):
+            os.unlink(tmp_fn)
+        raise
+
+
+def url_request(u, headers=None):
+    resp = _POOL.request('GET', u, headers=headers, preload_content=False)
+    if resp.status not in (200, 304):
+        resp.release_conn()
+        raise urllib3.exceptions.HTTPError('%s: HTTP status %d' % (u, resp.status))
+    return resp
+
+
+def url_is_immutable(u):
+    # everything under a circa directory is a snapshot which never changes
+    m = CIRCA_RE.search(u)
+    return bool(m and m.group(1))
+
+
+def cache_key(u):
+    return u.replace('http://', '').replace('/', '_')
 
-def url_retrieve_cached(u):
-    cache_fn = os.path.join(CACHE_DIR, u.replace('http://', '').replace(os.path.sep, '_'))
 
-    if not os.path.isfile(cache_fn):
-        (filename, headers) = urllib.request.urlretrieve(u, cache_fn)
-        print('fetching %s' % u, file=sys.stderr)
+def url_retrieve_cached(u):
+    cache_fn = f'{CACHE_DIR}/{cache_key(u)}'
+    meta_fn = cache_fn + '.meta'
+
+    if os.path.isfile(cache_fn):
+        if url_is_immutable(u):
+            # print('%s from cache' % cache_fn, file=sys.stderr)
+            return cache_fn
+
+        # otherwise, revalidate the cached copy with a conditional GET
+        headers = {}
+        if os.path.isfile(meta_fn):
+            with open(meta_fn) as f:
+                meta = json.load(f)
+            if 'etag' in meta:
+                headers['If-None-Match'] = meta['etag']
+            if 'last-modified' in meta:
+                headers['If-Modified-Since'] = meta['last-modified']
     else:
-        filename = cache_fn
-        # print('%s from cache' % filename, file=sys.stderr)
+        headers = None
+
+    resp = url_request(u, headers)
+    if resp.status == 304:
+        resp.release_conn()
+        return cache_fn
+
+    with atomic_write(cache_fn, 'wb') as f:
+        shutil.copyfileobj(resp, f)
+    resp.release_conn()
+    print('fetching %s' % u, file=sys.stderr)
 
-    return filename
+    # record validators for revalidating a mutable file
+    if not url_is_immutable(u):
+        meta = {k: resp.headers[k] for k in ('etag', 'last-modified') if k in resp.headers}
+        with atomic_write(meta_fn, 'w') as f:
+            json.dump(meta, f)
+
+    return cache_fn
 
 
 class source:
@@ -49,6 +132,45 @@ class source:
         self.author = author
 
 
+class circa_index_parser(html.parser.HTMLParser):
+    # collects the URLs of circas from the table cells of the CTM index
+    def __init__(self):
+        super().__init__()
+        self.urls = []
+        self.td = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'td':
+            self.td = ''
+
+    def handle_endtag(self, tag):
+        if tag == 'td' and self.td is not None:
+            if self.td.startswith('http'):
+                self.urls.append(self.td)
+            self.td = None
+
+    def handle_data(self, data):
+        if self.td is not None:
+            self.td += data
+
+
+def circa_to_epoch(circa):
+    return calendar.timegm(time.strptime(circa, '%Y/%m/%d/%H%M%S'))
+
+
+# helpers for writing a git fast-import stream
+def fi_path(path):
+    # always use the C-style quoted form, so any path can be represented
+    p = os.fsencode(path)
+    return b'"' + p.replace(b'\\', b'\\\\').replace(b'"', b'\\"').replace(b'\n', b'\\n') + b'"'
+
+
+def fi_data(stream, data):
+    stream.write(b'data %d\n' % len(data))
+    stream.write(data)
+    stream.write(b'\n')
+
+
 def ctm_to_sourcelist(args):
     if args.arch == 'x86':
         index_url = "http://ctm.crouchingtigerhiddenfruitbat.org/pub/cygwin/circa/index.html"
@@ -56,32 +178,47 @@ def ctm_to_sourcelist(args):
         index_url = "http://ctm.crouchingtigerhiddenfruitbat.org/pub/cygwin/circa/64bit/index.html"
 
     # read index, build list of setup.uni URLs
-    urls = []
-    html = urllib.request.urlopen(index_url).read().decode()
-    for l in html.splitlines():
-        m = re.search('<td>(http.*)</td>', l)
-        if m:
-            urls.append(m.group(1) + '/setup.ini')
+    index_parser = circa_index_parser()
+    with open(url_retrieve_cached(index_url), encoding='utf-8') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            index_parser.feed(chunk)
+    index_parser.close()
+    urls = [u + '/setup.ini' for u in index_parser.urls]
 
     # for each setup.ini URL, fetch it and parse details for selected package
+    #
+    # fetches are done concurrently, but results are consumed (and parsed) in
+    # index order on this thread, as the order in which they are merged matters
     sources = {}
-    for u in tqdm(urls):
-        circa = re.search('^(.*)/setup.ini$', u).group(1)
-        filename = url_retrieve_cached(u)
-
-        # parse it
-        with open(filename, errors='ignore') as f:
-            s = parse_setup_ini(f.read(), args.package[0])
-            for v in s:
-                # because we circas are ordered newest to oldest, data from the
-                # oldest circa to contain a version overwrites that from all
-                # newer circas
-                if (args.since is None) or (calm.version.SetupVersion(v) > calm.version.SetupVersion(args.since[0])):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        filenames = executor.map(url_retrieve_cached, urls)
+        try:
+            for (u, filename) in tqdm(zip(urls, filenames), total=len(urls)):
+                circa = SETUP_TAIL_RE.search(u).group(1)
+
+                # parse it
+                s = setup_ini_index(filename).get(args.package[0], {})
+                for v in s:
+                    # because we circas are ordered newest to oldest, data from the
+                    # oldest circa to contain a version overwrites that from all
+                    # newer circas
                     sources[v] = circa + '/' + s[v]
+        except BaseException:
+            # don't wait for all the remaining queued fetches to complete
+            # before reporting the failure
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    # parse each distinct version once, for both filtering and sorting
+    keyed = [(calm.version.SetupVersion(v), v) for v in sources]
+    keyed.sort(key=lambda t: t[0])
+
+    since_v = calm.version.SetupVersion(args.since[0]) if args.since else None
 
     # show versions and sources
-    for v in sorted(sources.keys(), key=calm.version.SetupVersion):
-        print(v, sources[v], DEFAULT_AUTHOR)
+    for (k, v) in keyed:
+        if since_v is None or k > since_v:
+            print(v, sources[v], DEFAULT_AUTHOR)
 
 
 def sourcelist_to_repo(args):
@@ -90,9 +227,9 @@ def sourcelist_to_repo(args):
     # read from provided filename
     sources = {}
     with open(args.sourcelist[0]) as f:
-        for l in f.readlines():
-            l = l.strip()
+        for l in f:
             (v, url, author) = l.split(sep=None, maxsplit=2)
+            author = author.rstrip()
             if author == DEFAULT_AUTHOR:
                 print('Unknown author still in sourcelist', file=sys.stderr)
                 exit(1)
@@ -111,6 +248,15 @@ def sourcelist_to_repo(args):
 
         subprocess.check_call(['git', 'init', '--initial-branch=master'])
 
+    # when appending, the first commit must have the existing branch head as
+    # its parent
+    parent = subprocess.call(['git', 'rev-parse', '--verify', '--quiet', 'refs/heads/master'], stdout=subprocess.DEVNULL) == 0
+
+    # commits are made by streaming them into a single git fast-import process
+    fast_import = subprocess.Popen(['git', 'fast-import', '--quiet', '--date-format=raw'], stdin=subprocess.PIPE)
+    stream = fast_import.stdin
+    mark = 0
+
     # for each unique source...
     for v in sources:
         # fetch it
@@ -118,79 +264,127 @@ def sourcelist_to_repo(args):
         author = sources[v].author
         filename = url_retrieve_cached(url)
 
-        # clean working directory
-        with os.scandir('.') as entries:
-            for entry in entries:
-                if entry.path == './.git':
+        # read the files out of the source package archive, streaming their
+        # contents straight into fast-import as blobs
+        files = []
+        with xtarfile.open(filename, mode='r') as archive:
+            # Look inside source package archive to see if filenames start
+            # with a directory with a name ending with '.src' (as current
+            # versions of cygport make) ...
+            # (members are read lazily, so this usually stops at the first)
+            strip = any(SRC_DIR_RE.match(m.name) for m in archive)
+
+            for m in archive:
+                # ... if so, trim that
+                name = m.name
+                if strip:
+                    if '/' not in name:
+                        continue
+                    name = name.split('/', 1)[1]
+                name = posixpath.normpath(name).lstrip('/')
+
+                # skip anything which would be outside the tree (as tar does)
+                if name == '..' or name.startswith('../'):
                     continue
-                elif entry.is_dir() and not entry.is_symlink():
-                    shutil.rmtree(entry.path)
-                else:
-                    os.remove(entry.path)
 
-        # Look inside source package archive to see if filenames start with a
-        # directory with a name ending with '.src' (as current versions of
-        # cygport make) ...
-        with xtarfile.open(filename, mode='r') as archive:
-            strip = any(re.match(r'[^/]*\.src/', f) for f in archive.getnames())
+                # skip upstream tarball(s), .sig files
+                if '/' not in name and name.endswith(REMOVE_EXTS):
+                    continue
 
-        # ... if so, use --strip-components to trim that
-        extra_args = ''
-        if strip:
-            extra_args = '--strip-components=1'
+                # skip the unarchived upstream source, if included in a
+                # g-b-s package
+                if name.split('/', 1)[0] == package + '-' + v:
+                    continue
 
-        # unpack it
-        subprocess.check_call(['tar', '-x', extra_args, '-f', filename])
+                if m.issym():
+                    mode = b'120000'
+                elif m.isreg() or m.islnk():
+                    mode = b'100755' if m.mode & 0o100 else b'100644'
+                else:
+                    continue
 
-        # remove upstream tarball(s), .sig files
-        with os.scandir('.') as entries:
-            for entry in entries:
-                if any(entry.path.endswith(ext) for ext in REMOVE_EXTS):
-                    os.remove(entry.path)
+                mark += 1
+                stream.write(b'blob\nmark :%d\n' % mark)
+                if m.issym():
+                    fi_data(stream, os.fsencode(m.linkname))
+                elif m.isreg():
+                    stream.write(b'data %d\n' % m.size)
+                    shutil.copyfileobj(archive.extractfile(m), stream)
+                    stream.write(b'\n')
+                else:
+                    # a hardlink
+                    fi_data(stream, archive.extractfile(m).read())
 
-        # if the unarchived upstream source is included in a g-b-s package
-        if os.path.isdir(package + '-' + v):
-            shutil.rmtree(package + '-' + v)
+                files.append((mode, mark, name))
 
         # avoid trying to make empty commits for very old source packages with
         # which we can do nothing useful
-        if len(list(os.scandir('.'))) <= 1:
+        if not files:
             if not args.allow_empty:
                 continue
 
         # create a git commit
-        subprocess.check_call(['git', 'add', '--all', '-f', '.'])
-        circa = re.search(r'circa/(?:64bit/|)([\d/]*)/', url).group(1)
-        date = circa + ' UTC'
+        circa = CIRCA_RE.search(url).group(1)
+        date = '%d +0000' % circa_to_epoch(circa)
+        committer = '%s <%s>' % (AUTHOR_NAME_RE.search(author).group(1), AUTHOR_EMAIL_RE.search(author).group(1))
+
+        message = '%s %s\n\nctm2git-circa: %s\n' % (package, v, circa)
+        stream.write(b'commit refs/heads/master\n')
+        stream.write(('author %s %s\n' % (author, date)).encode())
+        stream.write(('committer %s %s\n' % (committer, date)).encode())
+        fi_data(stream, message.encode())
+        if parent:
+            stream.write(b'from refs/heads/master^0\n')
+            parent = False
+        stream.write(b'deleteall\n')
+        for (mode, mark, name) in files:
+            stream.write(b'M %s :%d %s\n' % (mode, mark, fi_path(name)))
+        stream.write(b'\n')
+
+    stream.close()
+    if fast_import.wait() != 0:
+        print('git fast-import failed', file=sys.stderr)
+        exit(1)
+
+    # update the index and working directory to match the new branch head
+    if subprocess.call(['git', 'rev-parse', '--verify', '--quiet', 'refs/heads/master'], stdout=subprocess.DEVNULL) == 0:
+        subprocess.check_call(['git', 'reset', '--hard', '--quiet'])
+
+
+def parse_setup_ini(contents):
+    # returns a dict, keyed by package, of dicts mapping version to source
+    parsed = {}
+    p = None
+    v = None
+
+    for m in INI_RE.finditer(contents):
+        if m.group('pkg') is not None:
+            p = parsed.setdefault(m.group('pkg'), {})
+        elif m.group('ver') is not None:
+            v = m.group('ver')
+        elif p is not None:
+            # this extracts the URL from the source: line for all version:
+            # lines for the package
+            p[v] = m.group('src')
 
-        env = os.environ.copy()
-        env['GIT_COMMITTER_NAME'] = re.search(r'^(.*) <', author).group(1)
-        env['GIT_COMMITTER_EMAIL'] = re.search(r'<(.*)>', author).group(1)
-        env['GIT_COMMITTER_DATE'] = date
+    return parsed
 
-        message = '%s %s\n\nctm2git-circa: %s' % (package, v, circa)
-        cmd = ['git', 'commit', '--author', author, '--date=%s' % date, '-m', message]
-        if args.allow_empty:
-            cmd.append('--allow-empty')
-        subprocess.check_call(cmd, env=env)
 
+def setup_ini_index(filename):
+    # parsing a setup.ini is relatively expensive, so keep the parsed form for
+    # all packages alongside it, for reuse by subsequent runs
+    idx_fn = filename + '.idx.json'
+    if os.path.isfile(idx_fn) and os.path.getmtime(idx_fn) >= os.path.getmtime(filename):
+        with open(idx_fn) as f:
+            return json.load(f)
 
-def parse_setup_ini(contents, package):
-    parsed = {}
+    with open(filename, errors='ignore') as f:
+        idx = parse_setup_ini(f.read())
 
-    for l in contents.splitlines():
-        if l.startswith('@'):
-            p = l[2:]
-        elif l.startswith('version:'):
-            v = l[9:]
-        elif l.startswith('source:'):
-            s = l[8:].split()[0]
-            # this extracts the URL from the source: line for all version: lines
-            # for the specified package
-            if p == package:
-                parsed[v] = s
+    with atomic_write(idx_fn, 'w') as f:
+        json.dump(idx, f)
 
-    return parsed
+    return idx
 
 
 parser = argparse.ArgumentParser(description='Make a git repository from CTM package history')